@@ -5,19 +5,28 @@ Speedtest Exporter for Prometheus
 A modern Prometheus exporter that runs Ookla's Speedtest CLI and exposes metrics.
 """
 
-import json
 import logging
 import os
 import subprocess
 import sys
 import threading
-from datetime import datetime
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future
 from shutil import which
-from typing import cast
-
-from flask import Flask, Response
-from prometheus_client import CONTENT_TYPE_LATEST, Gauge, generate_latest
+from wsgiref.types import StartResponse, WSGIEnvironment
+
+import orjson
+from flask import Flask
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Gauge,
+    generate_latest,
+)
 from waitress import serve
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
 # Configure logging
 logging.basicConfig(
@@ -33,35 +42,120 @@ logging.getLogger("waitress").setLevel(logging.WARNING)
 # Flask app
 app = Flask(__name__)
 
-# Prometheus metrics
+# Prometheus metrics. The speedtest gauges get their own registry so their
+# rendered text can be reused across cache hits, while the default registry's
+# process, GC and platform collectors are rendered fresh on every scrape.
+speedtest_registry = CollectorRegistry()
 speedtest_server_id = Gauge(
-    "speedtest_server_id", "Speedtest server ID used for testing"
+    "speedtest_server_id",
+    "Speedtest server ID used for testing",
+    registry=speedtest_registry,
 )
 speedtest_jitter = Gauge(
-    "speedtest_jitter_latency_milliseconds", "Speedtest jitter in milliseconds"
+    "speedtest_jitter_latency_milliseconds",
+    "Speedtest jitter in milliseconds",
+    registry=speedtest_registry,
 )
 speedtest_ping = Gauge(
-    "speedtest_ping_latency_milliseconds", "Speedtest ping latency in milliseconds"
+    "speedtest_ping_latency_milliseconds",
+    "Speedtest ping latency in milliseconds",
+    registry=speedtest_registry,
 )
 speedtest_download = Gauge(
-    "speedtest_download_bits_per_second", "Speedtest download speed in bits per second"
+    "speedtest_download_bits_per_second",
+    "Speedtest download speed in bits per second",
+    registry=speedtest_registry,
 )
 speedtest_upload = Gauge(
-    "speedtest_upload_bits_per_second", "Speedtest upload speed in bits per second"
+    "speedtest_upload_bits_per_second",
+    "Speedtest upload speed in bits per second",
+    registry=speedtest_registry,
+)
+speedtest_up = Gauge(
+    "speedtest_up",
+    "Speedtest status - 1 if successful, 0 if failed",
+    registry=speedtest_registry,
+)
+
+# The moving averages have no value until a speedtest succeeds, so they live
+# in a registry that is only rendered once they have been set
+ewma_registry = CollectorRegistry()
+speedtest_download_ewma = Gauge(
+    "speedtest_download_ewma_bits_per_second",
+    "Exponentially weighted moving average of download speed in bits per second",
+    registry=ewma_registry,
+)
+speedtest_upload_ewma = Gauge(
+    "speedtest_upload_ewma_bits_per_second",
+    "Exponentially weighted moving average of upload speed in bits per second",
+    registry=ewma_registry,
+)
+speedtest_ping_ewma = Gauge(
+    "speedtest_ping_ewma_latency_milliseconds",
+    "Exponentially weighted moving average of ping latency in milliseconds",
+    registry=ewma_registry,
+)
+
+# Metric keys paired with the setter of the gauge they feed
+_SETTERS: tuple[tuple[str, Callable[[float], None]], ...] = (
+    ("server_id", speedtest_server_id.set),
+    ("jitter", speedtest_jitter.set),
+    ("ping", speedtest_ping.set),
+    ("download", speedtest_download.set),
+    ("upload", speedtest_upload.set),
+    ("up", speedtest_up.set),
+)
+_EWMA_SETTERS: tuple[tuple[str, Callable[[float], None]], ...] = (
+    ("download", speedtest_download_ewma.set),
+    ("upload", speedtest_upload_ewma.set),
+    ("ping", speedtest_ping_ewma.set),
 )
-speedtest_up = Gauge("speedtest_up", "Speedtest status - 1 if successful, 0 if failed")
 
 # Configuration
 CACHE_DURATION = int(os.environ.get("SPEEDTEST_CACHE_DURATION", "0"))
 SERVER_ID = os.environ.get("SPEEDTEST_SERVER_ID")
 TIMEOUT = int(os.environ.get("SPEEDTEST_TIMEOUT", "90"))
 PORT = int(os.environ.get("SPEEDTEST_PORT", "9798"))
+EWMA_ALPHA = float(os.environ.get("SPEEDTEST_EWMA_ALPHA", "0.3"))
+# Scrapes block a worker thread for the whole speedtest run, so keep enough
+# threads around that /health and / stay responsive while one is in progress.
+THREADS = int(os.environ.get("SPEEDTEST_THREADS", "8"))
+
+# Unit conversion factors, applied inline on the scrape path
+BITS_PER_BYTE = 8.0
+MEGABITS_PER_BIT = 1e-6
+
+# Speedtest CLI, resolved to an absolute path once validated at startup
+_SPEEDTEST_BIN = "speedtest"
 
 # Cache
 _cache_lock = threading.Lock()
-last_test_time = datetime.min
+last_test_time = 0.0
 cached_metrics: dict[str, int | float] | None = None
 
+# Health check result as (monotonic timestamp, ok)
+HEALTH_CACHE_DURATION = 30
+_health_lock = threading.Lock()
+_health_cache: tuple[float, bool] | None = None
+
+# Smoothed values of successful speedtests, and the snapshot belonging to
+# cached_metrics (the gauges are only set from it at render time)
+_ewma: dict[str, float] = {}
+cached_ewma: dict[str, float] = {}
+_ewma_exposed = False
+
+# The Content-Type header is fixed; Content-Length has to be measured per
+# scrape because the default collectors are rendered fresh each time
+_METRICS_CONTENT_TYPE = ("Content-Type", CONTENT_TYPE_LATEST)
+
+# Last rendered speedtest gauges, keyed by the metrics dict they were built from
+_render_lock = threading.Lock()
+_rendered: tuple[dict[str, int | float], bytes] | None = None
+
+# Single-flight guard so concurrent scrapes share one speedtest run
+_inflight_lock = threading.Lock()
+_inflight: Future[dict[str, int | float]] | None = None
+
 
 class SpeedtestError(Exception):
     """Custom exception for speedtest errors."""
@@ -71,17 +165,30 @@ class SpeedtestError(Exception):
 
 def bytes_to_bits(bytes_per_sec: int | float) -> float:
     """Convert bytes per second to bits per second."""
-    return float(bytes_per_sec) * 8
+    return bytes_per_sec * BITS_PER_BYTE
 
 
 def bits_to_megabits(bits_per_sec: int | float) -> float:
     """Convert bits per second to megabits per second."""
-    return round(float(bits_per_sec) * 1e-6, 2)
+    return round(bits_per_sec * MEGABITS_PER_BIT, 2)
+
+
+def validate_ewma_alpha() -> None:
+    """Validate that the moving-average smoothing factor is usable."""
+    if not 0.0 < EWMA_ALPHA <= 1.0:
+        logger.error(
+            f"Invalid SPEEDTEST_EWMA_ALPHA {EWMA_ALPHA}: "
+            "must be greater than 0 and at most 1"
+        )
+        sys.exit(1)
 
 
 def validate_speedtest_binary() -> None:
     """Validate that the official Speedtest CLI is installed and accessible."""
-    if not which("speedtest"):
+    global _SPEEDTEST_BIN
+
+    speedtest_bin = which("speedtest")
+    if not speedtest_bin:
         logger.error(
             "Speedtest CLI not found. Please install from: "
             "https://www.speedtest.net/apps/cli"
@@ -90,7 +197,7 @@ def validate_speedtest_binary() -> None:
 
     try:
         result = subprocess.run(
-            ["speedtest", "--version"],
+            [speedtest_bin, "--version"],
             capture_output=True,
             text=True,
             timeout=10,
@@ -105,6 +212,7 @@ def validate_speedtest_binary() -> None:
             sys.exit(1)
 
         logger.info(f"Speedtest CLI validated: {result.stdout.strip()}")
+        _SPEEDTEST_BIN = speedtest_bin
 
     except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
         logger.error(f"Failed to validate Speedtest CLI: {e}")
@@ -122,8 +230,8 @@ def run_speedtest() -> dict[str, int | float]:
         SpeedtestError: If speedtest fails or returns invalid data
     """
     cmd = [
-        "speedtest",
-        "--format=json-pretty",
+        _SPEEDTEST_BIN,
+        "--format=json",
         "--progress=no",
         "--accept-license",
         "--accept-gdpr",
@@ -132,14 +240,20 @@ def run_speedtest() -> dict[str, int | float]:
     if SERVER_ID:
         cmd.extend(["--server-id", SERVER_ID])
 
-    logger.info(f"Running speedtest with command: {' '.join(cmd)}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Running speedtest with command: %s", " ".join(cmd))
 
     try:
+        # stderr is never inspected, so don't buffer it
         result = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=TIMEOUT, check=True
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=TIMEOUT,
+            check=True,
         )
 
-        data = json.loads(result.stdout)
+        data = orjson.loads(result.stdout)
 
         if "error" in data:
             raise SpeedtestError(f"Speedtest error: {data['error']}")
@@ -149,23 +263,28 @@ def run_speedtest() -> dict[str, int | float]:
                 f"Unexpected speedtest output type: {data.get('type')}"
             )
 
-        # Extract metrics
+        # Extract metrics (bandwidth is reported in bytes per second) and
+        # release the full result document, which is mostly unused
         metrics = {
             "server_id": int(data["server"]["id"]),
             "jitter": float(data["ping"]["jitter"]),
             "ping": float(data["ping"]["latency"]),
-            "download": bytes_to_bits(data["download"]["bandwidth"]),
-            "upload": bytes_to_bits(data["upload"]["bandwidth"]),
+            "download": data["download"]["bandwidth"] * BITS_PER_BYTE,
+            "upload": data["upload"]["bandwidth"] * BITS_PER_BYTE,
             "up": 1,
         }
-
-        logger.info(
-            f"Speedtest completed - Server: {metrics['server_id']}, "
-            f"Ping: {metrics['ping']:.2f}ms, "
-            f"Jitter: {metrics['jitter']:.2f}ms, "
-            f"Download: {bits_to_megabits(metrics['download']):.2f}Mbps, "
-            f"Upload: {bits_to_megabits(metrics['upload']):.2f}Mbps"
-        )
+        del data, result
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Speedtest completed - Server: %s, Ping: %.2fms, Jitter: %.2fms, "
+                "Download: %.2fMbps, Upload: %.2fMbps",
+                metrics["server_id"],
+                metrics["ping"],
+                metrics["jitter"],
+                metrics["download"] * MEGABITS_PER_BIT,
+                metrics["upload"] * MEGABITS_PER_BIT,
+            )
 
         return metrics
 
@@ -175,50 +294,100 @@ def run_speedtest() -> dict[str, int | float]:
 
     except subprocess.CalledProcessError as e:
         logger.error(f"Speedtest command failed: {e}")
-        if e.stdout:
+        # Only attempt to parse output that looks like a JSON object
+        if e.stdout and e.stdout.lstrip().startswith(b"{"):
             try:
-                error_data = json.loads(e.stdout)
+                error_data = orjson.loads(e.stdout)
                 if "error" in error_data:
                     raise SpeedtestError(f"Speedtest error: {error_data['error']}")
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 pass
         raise SpeedtestError("Speedtest command failed") from e
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Failed to parse speedtest JSON output: {e}")
         raise SpeedtestError("Invalid JSON output from speedtest") from e
 
 
+def update_ewma(metrics: dict[str, int | float]) -> dict[str, float]:
+    """Fold a successful speedtest result into the moving averages."""
+    for key, _ in _EWMA_SETTERS:
+        value = float(metrics[key])
+        previous = _ewma.get(key)
+        if previous is not None:
+            value = EWMA_ALPHA * value + (1.0 - EWMA_ALPHA) * previous
+        _ewma[key] = value
+    return dict(_ewma)
+
+
+def _valid_cached_metrics(now: float) -> dict[str, int | float] | None:
+    """Return the cached metrics if still fresh; caller holds _cache_lock."""
+    if (
+        CACHE_DURATION > 0
+        and cached_metrics is not None
+        and now - last_test_time < CACHE_DURATION
+    ):
+        return cached_metrics
+    return None
+
+
 def get_metrics() -> dict[str, int | float]:
     """
     Get speedtest metrics, using cache if available and valid.
 
+    Concurrent callers that miss the cache wait for the speedtest already in
+    progress instead of starting their own.
+
     Returns:
         Dictionary containing speedtest metrics
     """
-    global last_test_time, cached_metrics
+    global last_test_time, cached_metrics, cached_ewma, _inflight
 
-    now = datetime.now()
+    now = time.monotonic()
 
     with _cache_lock:
-        cache_valid = (
-            CACHE_DURATION > 0
-            and cached_metrics is not None
-            and (now - last_test_time).total_seconds() < CACHE_DURATION
-        )
-        if cache_valid:
-            logger.debug("Using cached metrics")
-            return cast(dict[str, int | float], cached_metrics)
+        cached = _valid_cached_metrics(now)
+    if cached is not None:
+        logger.debug("Using cached metrics")
+        return cached
+
+    # Lock order is _inflight_lock, then _cache_lock
+    with _inflight_lock:
+        future = _inflight
+        leader = future is None
+        if future is None:
+            # A speedtest may have finished since the check above
+            with _cache_lock:
+                cached = _valid_cached_metrics(now)
+            if cached is not None:
+                logger.debug("Using metrics cached by the previous speedtest")
+                return cached
+            future = _inflight = Future()
 
     try:
-        metrics = run_speedtest()
+        if not leader:
+            logger.debug("Waiting for in-flight speedtest")
+            return future.result()
+
+        try:
+            metrics = run_speedtest()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+
         with _cache_lock:
             cached_metrics = metrics
             last_test_time = now
+            cached_ewma = update_ewma(metrics)
+        future.set_result(metrics)
         return metrics
 
     except SpeedtestError as e:
-        logger.error(f"Speedtest failed: {e}")
+        # Coalesced callers share the leader's failure; report it only once
+        if leader:
+            logger.error(f"Speedtest failed: {e}")
+        else:
+            logger.debug(f"In-flight speedtest failed: {e}")
         return {
             "server_id": 0,
             "jitter": 0,
@@ -228,15 +397,32 @@ def get_metrics() -> dict[str, int | float]:
             "up": 0,
         }
 
+    finally:
+        if leader:
+            with _inflight_lock:
+                _inflight = None
+
+
+def update_prometheus_metrics(
+    metrics: dict[str, int | float], ewma: dict[str, float] | None = None
+) -> None:
+    """Update Prometheus metrics with speedtest results and moving averages."""
+    global _ewma_exposed
 
-def update_prometheus_metrics(metrics: dict[str, int | float]) -> None:
-    """Update Prometheus metrics with speedtest results."""
-    speedtest_server_id.set(metrics["server_id"])
-    speedtest_jitter.set(metrics["jitter"])
-    speedtest_ping.set(metrics["ping"])
-    speedtest_download.set(metrics["download"])
-    speedtest_upload.set(metrics["upload"])
-    speedtest_up.set(metrics["up"])
+    for key, setter in _SETTERS:
+        setter(metrics[key])
+    if ewma:
+        for key, setter in _EWMA_SETTERS:
+            setter(ewma[key])
+        _ewma_exposed = True
+
+
+def render_speedtest_metrics() -> bytes:
+    """Render the speedtest gauges, plus the moving averages once they are set."""
+    output = generate_latest(speedtest_registry)
+    if _ewma_exposed:
+        output += generate_latest(ewma_registry)
+    return output
 
 
 @app.route("/")
@@ -258,34 +444,102 @@ def index() -> str:
 @app.route("/health")
 def health() -> tuple[str, int]:
     """Health check endpoint."""
-    try:
-        # Quick validation that speedtest binary is accessible
-        subprocess.run(
-            ["speedtest", "--version"], capture_output=True, timeout=5, check=True
-        )
-        return "OK", 200
-    except (
-        subprocess.TimeoutExpired,
-        subprocess.CalledProcessError,
-        FileNotFoundError,
-    ):
-        return "ERROR", 500
+    global _health_cache
+
+    cached = _health_cache
+    if cached is not None and time.monotonic() - cached[0] < HEALTH_CACHE_DURATION:
+        return ("OK", 200) if cached[1] else ("ERROR", 500)
+
+    with _health_lock:
+        # Another probe may have refreshed the result while we waited
+        now = time.monotonic()
+        cached = _health_cache
+        if cached is not None and now - cached[0] < HEALTH_CACHE_DURATION:
+            ok = cached[1]
+        else:
+            try:
+                # Quick validation that speedtest binary is accessible
+                subprocess.run(
+                    [_SPEEDTEST_BIN, "--version"],
+                    capture_output=True,
+                    timeout=5,
+                    check=True,
+                )
+                ok = True
+            except (
+                subprocess.TimeoutExpired,
+                subprocess.CalledProcessError,
+                FileNotFoundError,
+            ):
+                ok = False
+            _health_cache = (now, ok)
+
+    return ("OK", 200) if ok else ("ERROR", 500)
+
+
+def _plain_response(
+    start_response: StartResponse,
+    status: str,
+    body: bytes,
+    extra_headers: list[tuple[str, str]] | None = None,
+) -> Iterable[bytes]:
+    """Send a short plain-text WSGI response."""
+    headers = [
+        ("Content-Type", "text/plain; charset=utf-8"),
+        ("Content-Length", str(len(body))),
+    ]
+    start_response(status, headers + (extra_headers or []))
+    return [body]
 
 
-@app.route("/metrics")
-def metrics() -> Response:
-    """Prometheus metrics endpoint."""
+def metrics(environ: WSGIEnvironment, start_response: StartResponse) -> Iterable[bytes]:
+    """Prometheus metrics endpoint, served as a bare WSGI application."""
+    global _rendered
+
+    # Match the Flask route this replaces: only the exact path, GET and HEAD
+    if environ.get("PATH_INFO", ""):
+        return _plain_response(start_response, "404 NOT FOUND", b"Not Found")
+
+    if environ.get("REQUEST_METHOD", "GET") not in ("GET", "HEAD"):
+        return _plain_response(
+            start_response,
+            "405 METHOD NOT ALLOWED",
+            b"Method Not Allowed",
+            [("Allow", "GET, HEAD")],
+        )
+
     try:
         metrics_data = get_metrics()
-        update_prometheus_metrics(metrics_data)
+
+        # Cache hits return the same dict, so its gauges need not be re-rendered
+        with _render_lock:
+            if _rendered is None or _rendered[0] is not metrics_data:
+                # Failed runs have no averages of their own and leave them as is
+                with _cache_lock:
+                    ewma = cached_ewma if metrics_data is cached_metrics else None
+                update_prometheus_metrics(metrics_data, ewma)
+                _rendered = (metrics_data, render_speedtest_metrics())
+            speedtest_output = _rendered[1]
 
         # Generate Prometheus format
-        output = generate_latest()
-        return Response(output, mimetype=CONTENT_TYPE_LATEST)
+        output = generate_latest(REGISTRY) + speedtest_output
+        headers = [_METRICS_CONTENT_TYPE, ("Content-Length", str(len(output)))]
+        status = "200 OK"
 
     except Exception:
         logger.exception("Error generating metrics")
-        return Response("", mimetype=CONTENT_TYPE_LATEST, status=500)
+        output = b""
+        headers = [_METRICS_CONTENT_TYPE, ("Content-Length", "0")]
+        status = "500 INTERNAL SERVER ERROR"
+
+    start_response(status, headers)
+    return [output]
+
+
+# Serve /metrics without going through Flask's routing and request context
+app.wsgi_app = DispatcherMiddleware(  # type: ignore[method-assign]
+    app.wsgi_app, {"/metrics": metrics}
+)
 
 
 def main() -> None:
@@ -298,8 +552,11 @@ def main() -> None:
     logger.info(f"  Cache Duration: {CACHE_DURATION}s")
     logger.info(f"  Timeout: {TIMEOUT}s")
     logger.info(f"  Server ID: {SERVER_ID or 'Auto'}")
+    logger.info(f"  Threads: {THREADS}")
+    logger.info(f"  EWMA Alpha: {EWMA_ALPHA}")
 
-    # Validate speedtest binary
+    # Validate configuration and speedtest binary
+    validate_ewma_alpha()
     validate_speedtest_binary()
 
     # Start server
@@ -308,7 +565,7 @@ def main() -> None:
         app,
         host="0.0.0.0",
         port=PORT,
-        threads=4,
+        threads=THREADS,
         cleanup_interval=30,
         channel_timeout=120,
     )
@@ -1,13 +1,18 @@
 """Tests for the speedtest exporter."""
 
 import json
+import logging
 import os
 import subprocess
 import sys
-from datetime import datetime, timedelta
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 from unittest.mock import Mock, patch
 
 import pytest
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY
 
 # Add src to path for imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -21,6 +26,7 @@ from exporter import (
     get_metrics,
     run_speedtest,
     update_prometheus_metrics,
+    validate_ewma_alpha,
     validate_speedtest_binary,
 )
 
@@ -43,6 +49,20 @@ VALID_METRICS = {
 }
 
 
+@contextmanager
+def waiting_followers():
+    """Patch Future.result so each follower signals just before it blocks."""
+    waiting = threading.Semaphore(0)
+    original_result = Future.result
+
+    def result(self, timeout=None):
+        waiting.release()
+        return original_result(self, timeout)
+
+    with patch.object(Future, "result", result):
+        yield waiting
+
+
 class TestUtilityFunctions:
     """Test utility functions."""
 
@@ -69,9 +89,25 @@ class TestSpeedtestError:
         assert issubclass(SpeedtestError, Exception)
 
 
+class TestValidateEwmaAlpha:
+    """Test moving-average smoothing factor validation."""
+
+    @pytest.mark.parametrize("alpha", [0.01, 0.3, 1.0])
+    def test_valid_alpha(self, alpha):
+        with patch("exporter.EWMA_ALPHA", alpha):
+            validate_ewma_alpha()  # should not raise
+
+    @pytest.mark.parametrize("alpha", [0.0, -0.5, 1.5])
+    def test_out_of_range_alpha_exits(self, alpha):
+        with patch("exporter.EWMA_ALPHA", alpha), pytest.raises(SystemExit) as exc:
+            validate_ewma_alpha()
+        assert exc.value.code == 1
+
+
 class TestValidateSpeedtestBinary:
     """Test speedtest binary validation."""
 
+    @patch("exporter._SPEEDTEST_BIN", "speedtest")
     @patch("exporter.which")
     @patch("exporter.subprocess.run")
     def test_valid_official_binary(self, mock_run, mock_which):
@@ -79,6 +115,16 @@ class TestValidateSpeedtestBinary:
         mock_run.return_value = Mock(stdout="Speedtest by Ookla 1.2.0\n", returncode=0)
         validate_speedtest_binary()  # should not raise
 
+    @patch("exporter._SPEEDTEST_BIN", "speedtest")
+    @patch("exporter.which")
+    @patch("exporter.subprocess.run")
+    def test_valid_binary_path_is_cached(self, mock_run, mock_which):
+        mock_which.return_value = "/usr/local/bin/speedtest"
+        mock_run.return_value = Mock(stdout="Speedtest by Ookla 1.2.0\n", returncode=0)
+        validate_speedtest_binary()
+        assert mock_run.call_args[0][0][0] == "/usr/local/bin/speedtest"
+        assert exporter._SPEEDTEST_BIN == "/usr/local/bin/speedtest"
+
     @patch("exporter.which")
     def test_binary_not_found_exits(self, mock_which):
         mock_which.return_value = None
@@ -120,7 +166,7 @@ class TestRunSpeedtest:
     @patch("exporter.subprocess.run")
     def test_success_returns_correct_metrics(self, mock_run):
         mock_run.return_value = Mock(
-            stdout=json.dumps(VALID_SPEEDTEST_JSON), returncode=0
+            stdout=json.dumps(VALID_SPEEDTEST_JSON).encode(), returncode=0
         )
         result = run_speedtest()
         assert result["server_id"] == 12345
@@ -130,6 +176,16 @@ class TestRunSpeedtest:
         assert result["upload"] == bytes_to_bits(6250000)
         assert result["up"] == 1
 
+    @patch("exporter.subprocess.run")
+    def test_stderr_is_discarded(self, mock_run):
+        mock_run.return_value = Mock(
+            stdout=json.dumps(VALID_SPEEDTEST_JSON).encode(), returncode=0
+        )
+        run_speedtest()
+        kwargs = mock_run.call_args[1]
+        assert kwargs["stdout"] == subprocess.PIPE
+        assert kwargs["stderr"] == subprocess.DEVNULL
+
     @patch("exporter.subprocess.run")
     def test_timeout_raises_speedtest_error(self, mock_run):
         mock_run.side_effect = subprocess.TimeoutExpired(cmd="speedtest", timeout=90)
@@ -138,31 +194,39 @@ class TestRunSpeedtest:
 
     @patch("exporter.subprocess.run")
     def test_process_error_raises_speedtest_error(self, mock_run):
-        mock_run.side_effect = subprocess.CalledProcessError(
-            1, "speedtest", output=""
-        )
+        mock_run.side_effect = subprocess.CalledProcessError(1, "speedtest", output=b"")
         with pytest.raises(SpeedtestError):
             run_speedtest()
 
     @patch("exporter.subprocess.run")
     def test_process_error_with_json_error_message(self, mock_run):
-        error_output = json.dumps({"error": "No servers available"})
+        error_output = json.dumps({"error": "No servers available"}).encode()
         mock_run.side_effect = subprocess.CalledProcessError(
             1, "speedtest", output=error_output
         )
         with pytest.raises(SpeedtestError, match="No servers available"):
             run_speedtest()
 
+    @patch("exporter.orjson.loads")
+    @patch("exporter.subprocess.run")
+    def test_process_error_with_plain_output_skips_parsing(self, mock_run, mock_loads):
+        mock_run.side_effect = subprocess.CalledProcessError(
+            1, "speedtest", output=b"Configuration - Could not retrieve servers\n"
+        )
+        with pytest.raises(SpeedtestError, match="command failed"):
+            run_speedtest()
+        mock_loads.assert_not_called()
+
     @patch("exporter.subprocess.run")
     def test_invalid_json_raises_speedtest_error(self, mock_run):
-        mock_run.return_value = Mock(stdout="not valid json", returncode=0)
+        mock_run.return_value = Mock(stdout=b"not valid json", returncode=0)
         with pytest.raises(SpeedtestError, match="Invalid JSON"):
             run_speedtest()
 
     @patch("exporter.subprocess.run")
     def test_error_field_in_result_raises(self, mock_run):
         mock_run.return_value = Mock(
-            stdout=json.dumps({"error": "Connection failed"}), returncode=0
+            stdout=json.dumps({"error": "Connection failed"}).encode(), returncode=0
         )
         with pytest.raises(SpeedtestError, match="Connection failed"):
             run_speedtest()
@@ -170,7 +234,8 @@ class TestRunSpeedtest:
     @patch("exporter.subprocess.run")
     def test_unexpected_result_type_raises(self, mock_run):
         mock_run.return_value = Mock(
-            stdout=json.dumps({"type": "log", "message": "test"}), returncode=0
+            stdout=json.dumps({"type": "log", "message": "test"}).encode(),
+            returncode=0,
         )
         with pytest.raises(SpeedtestError, match="Unexpected"):
             run_speedtest()
@@ -179,18 +244,27 @@ class TestRunSpeedtest:
     @patch("exporter.subprocess.run")
     def test_server_id_included_in_command(self, mock_run):
         mock_run.return_value = Mock(
-            stdout=json.dumps(VALID_SPEEDTEST_JSON), returncode=0
+            stdout=json.dumps(VALID_SPEEDTEST_JSON).encode(), returncode=0
         )
         run_speedtest()
         cmd = mock_run.call_args[0][0]
         assert "--server-id" in cmd
         assert "67890" in cmd
 
+    @patch("exporter._SPEEDTEST_BIN", "/usr/local/bin/speedtest")
+    @patch("exporter.subprocess.run")
+    def test_resolved_binary_used_in_command(self, mock_run):
+        mock_run.return_value = Mock(
+            stdout=json.dumps(VALID_SPEEDTEST_JSON).encode(), returncode=0
+        )
+        run_speedtest()
+        assert mock_run.call_args[0][0][0] == "/usr/local/bin/speedtest"
+
     @patch("exporter.SERVER_ID", None)
     @patch("exporter.subprocess.run")
     def test_no_server_id_not_in_command(self, mock_run):
         mock_run.return_value = Mock(
-            stdout=json.dumps(VALID_SPEEDTEST_JSON), returncode=0
+            stdout=json.dumps(VALID_SPEEDTEST_JSON).encode(), returncode=0
         )
         run_speedtest()
         cmd = mock_run.call_args[0][0]
@@ -203,7 +277,10 @@ class TestGetMetrics:
     def setup_method(self):
         """Reset global cache state before each test."""
         exporter.cached_metrics = None
-        exporter.last_test_time = datetime.min
+        exporter.last_test_time = 0.0
+        exporter._inflight = None
+        exporter._ewma.clear()
+        exporter.cached_ewma = {}
 
     @patch("exporter.run_speedtest")
     def test_no_cache_runs_speedtest(self, mock_run):
@@ -216,7 +293,7 @@ class TestGetMetrics:
     @patch("exporter.run_speedtest")
     def test_valid_cache_skips_speedtest(self, mock_run):
         exporter.cached_metrics = VALID_METRICS.copy()
-        exporter.last_test_time = datetime.now()
+        exporter.last_test_time = time.monotonic()
         result = get_metrics()
         mock_run.assert_not_called()
         assert result == VALID_METRICS
@@ -228,7 +305,7 @@ class TestGetMetrics:
         fresh_metrics["server_id"] = 99999
         mock_run.return_value = fresh_metrics
         exporter.cached_metrics = VALID_METRICS.copy()
-        exporter.last_test_time = datetime.now() - timedelta(seconds=400)
+        exporter.last_test_time = time.monotonic() - 400
         result = get_metrics()
         mock_run.assert_called_once()
         assert result["server_id"] == 99999
@@ -238,7 +315,7 @@ class TestGetMetrics:
     def test_cache_duration_zero_always_reruns(self, mock_run):
         mock_run.return_value = VALID_METRICS.copy()
         exporter.cached_metrics = VALID_METRICS.copy()
-        exporter.last_test_time = datetime.now()
+        exporter.last_test_time = time.monotonic()
         get_metrics()
         mock_run.assert_called_once()
 
@@ -252,6 +329,116 @@ class TestGetMetrics:
         assert result["ping"] == 0
         assert result["server_id"] == 0
 
+    @patch("exporter.EWMA_ALPHA", 0.5)
+    @patch("exporter.run_speedtest")
+    def test_success_updates_moving_averages(self, mock_run):
+        slower = VALID_METRICS.copy()
+        slower["download"] = VALID_METRICS["download"] / 2
+        mock_run.side_effect = [VALID_METRICS.copy(), slower]
+        get_metrics()
+        assert exporter._ewma["download"] == VALID_METRICS["download"]
+        get_metrics()
+        assert exporter._ewma["download"] == VALID_METRICS["download"] * 0.75
+        assert exporter.cached_ewma["download"] == VALID_METRICS["download"] * 0.75
+
+    @patch("exporter.run_speedtest")
+    def test_failure_leaves_moving_averages_unchanged(self, mock_run):
+        mock_run.side_effect = [VALID_METRICS.copy(), SpeedtestError("failed")]
+        get_metrics()
+        get_metrics()
+        assert exporter._ewma["ping"] == VALID_METRICS["ping"]
+        assert exporter.cached_ewma["ping"] == VALID_METRICS["ping"]
+
+    @patch("exporter.CACHE_DURATION", 300)
+    @patch("exporter.run_speedtest")
+    def test_speedtest_finishing_between_checks_is_not_rerun(self, mock_run):
+        real_lock = exporter._inflight_lock
+
+        class LeaderFinishesFirst:
+            """Let a previous leader fill the cache before the lock is taken."""
+
+            def __enter__(self):
+                exporter.cached_metrics = VALID_METRICS.copy()
+                exporter.last_test_time = time.monotonic()
+                return real_lock.__enter__()
+
+            def __exit__(self, *exc_info):
+                return real_lock.__exit__(*exc_info)
+
+        with patch("exporter._inflight_lock", LeaderFinishesFirst()):
+            result = get_metrics()
+
+        mock_run.assert_not_called()
+        assert result == VALID_METRICS
+        assert exporter._inflight is None
+
+    @patch("exporter.run_speedtest")
+    def test_concurrent_calls_share_one_speedtest(self, mock_run):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_speedtest():
+            started.set()
+            release.wait(timeout=5)
+            return VALID_METRICS.copy()
+
+        mock_run.side_effect = slow_speedtest
+        results = []
+
+        def call():
+            results.append(get_metrics())
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        assert started.wait(timeout=5)
+        followers = [threading.Thread(target=call) for _ in range(4)]
+        with waiting_followers() as waiting:
+            for t in followers:
+                t.start()
+            for _ in followers:
+                assert waiting.acquire(timeout=5)
+            release.set()
+            for t in [leader, *followers]:
+                t.join(timeout=5)
+
+        mock_run.assert_called_once()
+        assert results == [VALID_METRICS] * 5
+        assert exporter._inflight is None
+
+    @patch("exporter.run_speedtest")
+    def test_concurrent_failure_returns_zeros_to_all(self, mock_run, caplog):
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing_speedtest():
+            started.set()
+            release.wait(timeout=5)
+            raise SpeedtestError("Connection failed")
+
+        mock_run.side_effect = failing_speedtest
+        results = []
+
+        def call():
+            results.append(get_metrics())
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        assert started.wait(timeout=5)
+        follower = threading.Thread(target=call)
+        with waiting_followers() as waiting:
+            follower.start()
+            assert waiting.acquire(timeout=5)
+            release.set()
+            leader.join(timeout=5)
+            follower.join(timeout=5)
+
+        mock_run.assert_called_once()
+        assert [r["up"] for r in results] == [0, 0]
+        errors = [r for r in caplog.records if r.levelno == logging.ERROR]
+        assert [r.getMessage() for r in errors] == [
+            "Speedtest failed: Connection failed"
+        ]
+
 
 class TestUpdatePrometheusMetrics:
     """Test that Prometheus gauges are updated correctly."""
@@ -265,21 +452,50 @@ class TestUpdatePrometheusMetrics:
             "upload": 50_000_000.0,
             "up": 1,
         }
-        with (
-            patch.object(exporter.speedtest_server_id, "set") as mock_sid,
-            patch.object(exporter.speedtest_jitter, "set") as mock_jitter,
-            patch.object(exporter.speedtest_ping, "set") as mock_ping,
-            patch.object(exporter.speedtest_download, "set") as mock_dl,
-            patch.object(exporter.speedtest_upload, "set") as mock_ul,
-            patch.object(exporter.speedtest_up, "set") as mock_up,
-        ):
-            update_prometheus_metrics(metrics)
-            mock_sid.assert_called_once_with(42)
-            mock_jitter.assert_called_once_with(1.5)
-            mock_ping.assert_called_once_with(12.3)
-            mock_dl.assert_called_once_with(100_000_000.0)
-            mock_ul.assert_called_once_with(50_000_000.0)
-            mock_up.assert_called_once_with(1)
+        update_prometheus_metrics(metrics)
+        assert exporter.speedtest_registry.get_sample_value("speedtest_server_id") == 42
+        assert (
+            exporter.speedtest_registry.get_sample_value(
+                "speedtest_jitter_latency_milliseconds"
+            )
+            == 1.5
+        )
+        assert (
+            exporter.speedtest_registry.get_sample_value(
+                "speedtest_ping_latency_milliseconds"
+            )
+            == 12.3
+        )
+        assert (
+            exporter.speedtest_registry.get_sample_value(
+                "speedtest_download_bits_per_second"
+            )
+            == 100_000_000.0
+        )
+        assert (
+            exporter.speedtest_registry.get_sample_value(
+                "speedtest_upload_bits_per_second"
+            )
+            == 50_000_000.0
+        )
+        assert exporter.speedtest_registry.get_sample_value("speedtest_up") == 1
+
+    def test_sets_moving_average_gauges(self):
+        ewma = {"download": 80_000_000.0, "upload": 40_000_000.0, "ping": 11.0}
+        update_prometheus_metrics(VALID_METRICS, ewma)
+        registry = exporter.ewma_registry
+        assert (
+            registry.get_sample_value("speedtest_download_ewma_bits_per_second")
+            == 80_000_000.0
+        )
+        assert (
+            registry.get_sample_value("speedtest_upload_ewma_bits_per_second")
+            == 40_000_000.0
+        )
+        assert (
+            registry.get_sample_value("speedtest_ping_ewma_latency_milliseconds")
+            == 11.0
+        )
 
     def test_sets_failure_metrics(self):
         metrics = {
@@ -290,14 +506,24 @@ class TestUpdatePrometheusMetrics:
             "upload": 0,
             "up": 0,
         }
-        with patch.object(exporter.speedtest_up, "set") as mock_up:
-            update_prometheus_metrics(metrics)
-            mock_up.assert_called_once_with(0)
+        update_prometheus_metrics(metrics)
+        assert exporter.speedtest_registry.get_sample_value("speedtest_up") == 0
 
 
 class TestFlaskApp:
     """Test Flask application endpoints."""
 
+    def setup_method(self):
+        """Reset cached endpoint and speedtest state before each test."""
+        exporter._health_cache = None
+        exporter._rendered = None
+        exporter._ewma_exposed = False
+        exporter.cached_metrics = None
+        exporter.last_test_time = 0.0
+        exporter._inflight = None
+        exporter._ewma.clear()
+        exporter.cached_ewma = {}
+
     @patch("exporter.subprocess.run")
     def test_health_endpoint_success(self, mock_run):
         mock_run.return_value = Mock(returncode=0)
@@ -321,6 +547,25 @@ class TestFlaskApp:
             response = client.get("/health")
             assert response.status_code == 500
 
+    @patch("exporter.subprocess.run")
+    def test_health_endpoint_uses_cached_result(self, mock_run):
+        mock_run.return_value = Mock(returncode=0)
+        with app.test_client() as client:
+            assert client.get("/health").status_code == 200
+            mock_run.side_effect = FileNotFoundError()
+            assert client.get("/health").status_code == 200
+        mock_run.assert_called_once()
+
+    @patch("exporter.HEALTH_CACHE_DURATION", 0)
+    @patch("exporter.subprocess.run")
+    def test_health_endpoint_rechecks_after_expiry(self, mock_run):
+        mock_run.return_value = Mock(returncode=0)
+        with app.test_client() as client:
+            assert client.get("/health").status_code == 200
+            mock_run.side_effect = FileNotFoundError()
+            assert client.get("/health").status_code == 500
+        assert mock_run.call_count == 2
+
     def test_index_endpoint_returns_html(self):
         with app.test_client() as client:
             response = client.get("/")
@@ -336,8 +581,112 @@ class TestFlaskApp:
         with app.test_client() as client:
             response = client.get("/metrics")
             assert response.status_code == 200
+            assert response.headers["Content-Type"] == CONTENT_TYPE_LATEST
             assert b"speedtest_up" in response.data
 
+    @patch("exporter.get_metrics")
+    def test_metrics_endpoint_reuses_payload_for_cached_metrics(self, mock_get_metrics):
+        mock_get_metrics.return_value = VALID_METRICS.copy()
+        with (
+            app.test_client() as client,
+            patch.object(
+                exporter, "update_prometheus_metrics", wraps=update_prometheus_metrics
+            ) as mock_update,
+        ):
+            first = client.get("/metrics").data
+            second = client.get("/metrics").data
+        mock_update.assert_called_once()
+        assert b"speedtest_up 1.0" in first
+        assert b"speedtest_up 1.0" in second
+
+    @patch("exporter.run_speedtest")
+    def test_metrics_endpoint_failure_keeps_moving_averages(self, mock_run):
+        mock_run.side_effect = [VALID_METRICS.copy(), SpeedtestError("failed")]
+        with app.test_client() as client:
+            client.get("/metrics")
+            response = client.get("/metrics")
+        assert b"speedtest_up 0.0" in response.data
+        assert (
+            f"speedtest_ping_ewma_latency_milliseconds {VALID_METRICS['ping']}"
+            in response.data.decode()
+        )
+
+    @patch("exporter.run_speedtest")
+    def test_metrics_endpoint_hides_moving_averages_until_first_success(self, mock_run):
+        mock_run.side_effect = SpeedtestError("failed")
+        with app.test_client() as client:
+            response = client.get("/metrics")
+        assert b"speedtest_up 0.0" in response.data
+        assert b"_ewma_" not in response.data
+
+    @patch("exporter.get_metrics")
+    def test_metrics_endpoint_content_length_covers_full_body(self, mock_get_metrics):
+        mock_get_metrics.return_value = VALID_METRICS.copy()
+        with app.test_client() as client:
+            for _ in range(2):
+                response = client.get("/metrics")
+                assert int(response.headers["Content-Length"]) == len(response.data)
+                assert b"speedtest_up" in response.data
+
+    @patch("exporter.get_metrics")
+    def test_metrics_endpoint_renders_process_metrics_on_cache_hits(
+        self, mock_get_metrics
+    ):
+        if REGISTRY.get_sample_value("process_cpu_seconds_total") is None:
+            pytest.skip("process metrics are not available on this platform")
+        mock_get_metrics.return_value = VALID_METRICS.copy()
+
+        def cpu_seconds(data):
+            for line in data.decode().splitlines():
+                if line.startswith("process_cpu_seconds_total "):
+                    return float(line.split()[1])
+            raise AssertionError("process_cpu_seconds_total missing")
+
+        with app.test_client() as client:
+            first = cpu_seconds(client.get("/metrics").data)
+            deadline = time.process_time() + 0.1
+            while time.process_time() < deadline:
+                pass
+            second = cpu_seconds(client.get("/metrics").data)
+        assert second > first
+
+    @patch("exporter.get_metrics")
+    def test_metrics_endpoint_rerenders_for_new_metrics(self, mock_get_metrics):
+        mock_get_metrics.side_effect = [VALID_METRICS.copy(), VALID_METRICS.copy()]
+        with (
+            app.test_client() as client,
+            patch.object(
+                exporter, "update_prometheus_metrics", wraps=update_prometheus_metrics
+            ) as mock_update,
+        ):
+            client.get("/metrics")
+            client.get("/metrics")
+        assert mock_update.call_count == 2
+
+    @patch("exporter.get_metrics")
+    def test_metrics_endpoint_head_allowed(self, mock_get_metrics):
+        mock_get_metrics.return_value = VALID_METRICS.copy()
+        with app.test_client() as client:
+            response = client.head("/metrics")
+            assert response.status_code == 200
+
+    @pytest.mark.parametrize("method", ["POST", "PUT", "DELETE"])
+    @patch("exporter.get_metrics")
+    def test_metrics_endpoint_rejects_other_methods(self, mock_get_metrics, method):
+        with app.test_client() as client:
+            response = client.open("/metrics", method=method)
+            assert response.status_code == 405
+            assert response.headers["Allow"] == "GET, HEAD"
+        mock_get_metrics.assert_not_called()
+
+    @pytest.mark.parametrize("path", ["/metrics/", "/metrics/foo"])
+    @patch("exporter.get_metrics")
+    def test_metrics_endpoint_subpaths_not_found(self, mock_get_metrics, path):
+        with app.test_client() as client:
+            response = client.get(path)
+            assert response.status_code == 404
+        mock_get_metrics.assert_not_called()
+
     @patch("exporter.get_metrics")
     def test_metrics_endpoint_unexpected_error_returns_500(self, mock_get_metrics):
         mock_get_metrics.side_effect = RuntimeError("Unexpected failure")